@@ -6,7 +6,7 @@ import os
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def load_MNIST(batch_size):
+def load_MNIST(batch_size, num_workers=0):
     """Load MNIST dataset
     Train set of 60000 images. Split into 3 parts:
     - 20000 images for training a labeling model (since generated images don't have labels)
@@ -16,6 +16,8 @@ def load_MNIST(batch_size):
         - Even numbers (20000 images) as a "private" training set
 
     Test set of 10000 images. Used for evaluating the downstream classifier.
+
+    num_workers > 0 keeps the worker processes alive between iterators (persistent_workers).
     """
     MNIST_fp = "data/MNIST"
     transform = transforms.ToTensor()
@@ -57,11 +59,13 @@ def load_MNIST(batch_size):
         torch.save(public_set, f"{MNIST_fp}/public_set.pt")
         torch.save(private_set, f"{MNIST_fp}/private_set.pt")
 
-    # Create data loaders
-    labeling_loader = torch.utils.data.DataLoader(labeling_set, batch_size=batch_size, shuffle=True)
-    public_loader = torch.utils.data.DataLoader(public_set, batch_size=batch_size, shuffle=True)
-    private_loader = torch.utils.data.DataLoader(private_set, batch_size=batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(test_set, batch_size=batch_size, shuffle=False)
+    # Create data loaders (pinned memory so host to device copies can be async)
+    loader_kwargs = dict(batch_size=batch_size, pin_memory=device.type == "cuda",
+        num_workers=num_workers, persistent_workers=num_workers > 0)
+    labeling_loader = torch.utils.data.DataLoader(labeling_set, shuffle=True, **loader_kwargs)
+    public_loader = torch.utils.data.DataLoader(public_set, shuffle=True, **loader_kwargs)
+    private_loader = torch.utils.data.DataLoader(private_set, shuffle=True, **loader_kwargs)
+    test_loader = torch.utils.data.DataLoader(test_set, shuffle=False, **loader_kwargs)
 
     return labeling_loader, public_loader, private_loader, test_loader
 
@@ -101,7 +101,7 @@ def gradient_ascent(model, imgs, latent_dim, start_lr=10, iterations=1000, laten
     model.eval()
     prev_loss = float("inf")
     for i in range(iterations):
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         output = model(latent_vectors)
         loss = criterion(output, imgs)
         loss.backward()
@@ -15,6 +15,9 @@ class Discriminator_FC(nn.Module):
     """
     def __init__(self, hidden_sizes=[64, 16], input_size=28**2, activation=nn.LeakyReLU(0.2, inplace=True)):
         super(Discriminator_FC, self).__init__()
+        # Plain ints (not numpy ints from sweeps) so the layers stay TorchScript compatible
+        hidden_sizes = [int(h) for h in hidden_sizes]
+        input_size = int(input_size)
         self.input_size = input_size
         self.model = nn.Sequential(
             nn.Linear(input_size, hidden_sizes[0]),
@@ -61,6 +64,21 @@ class Weight_Clipper(object):
         if hasattr(module, 'weight'):
             module.weight.data = module.weight.data.clamp(-self.clip_value, self.clip_value)
 
+    @staticmethod
+    def weights(model):
+        # Weights clipped by model.apply(clipper), collect once and pass to clip_
+        return [m.weight for m in model.modules() if isinstance(getattr(m, 'weight', None), torch.Tensor)]
+
+    def clip_(self, weights):
+        # Clip all weights in place, fused into multi-tensor kernels where available (torch>=2.0)
+        with torch.no_grad():
+            if hasattr(torch, '_foreach_clamp_min_'):
+                torch._foreach_clamp_min_(weights, -self.clip_value)
+                torch._foreach_clamp_max_(weights, self.clip_value)
+            else:
+                for w in weights:
+                    w.clamp_(-self.clip_value, self.clip_value)
+
 
 class Generator_MNIST(nn.Module):
     """ Convolutional Generator for MNIST image size (1, 28, 28)
@@ -110,8 +128,13 @@ class Generator_FC(nn.Module):
     """
     def __init__(self, hidden_sizes=[64, 16], nz=100, output_size=(1, 28, 28), sigmoid=True):
         super(Generator_FC, self).__init__()
+        # Plain ints (not numpy ints from sweeps) so the layers stay TorchScript compatible
+        hidden_sizes = [int(h) for h in hidden_sizes]
+        nz = int(nz)
         self.nz = nz
         self.output_size = output_size
+        # Flat list of ints so forward stays TorchScript compatible
+        self.output_shape = [-1] + np.atleast_1d(output_size).tolist()
 
         self.model = nn.Sequential(
             nn.Linear(nz, hidden_sizes[0]),
@@ -122,14 +145,14 @@ class Generator_FC(nn.Module):
                 nn.ReLU(True), 
                 nn.BatchNorm1d(hidden_sizes[i])
             ] for i in range(1, len(hidden_sizes))])),
-            nn.Linear(hidden_sizes[-1], np.prod(output_size)),
+            nn.Linear(hidden_sizes[-1], int(np.prod(output_size))),
             nn.Sigmoid() if sigmoid else nn.Identity()
         )
 
     def forward(self, x):
         # (batch_size, nz) -> (batch_size, output_size)
         out = self.model(x)
-        return out.view(-1, *self.output_size)
+        return out.view(self.output_shape)
 
 # Setup Generator Weight Initialization
 def G_weights_init(m):
@@ -6,23 +6,23 @@ from models import Discriminator_FC
 
 # Given parameter clip bounds c_p, compute maximal ReLU gradient bounds c_g
 def compute_ReLU_bounds(model, c_p, input_size=(784,), input_bounds=1.0, B_sigma_p=1.0):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    sample = torch.ones(input_size[0]).to(device) * input_bounds
+    # With every weight set to c_p and a uniform input, each layer output stays uniform:
+    # W @ sample = c_p * fan_in * s, so the bound is a scalar recurrence over layer shapes
+    shapes = [layer.weight.shape for layer in model.modules() if isinstance(layer, nn.Linear)]
+    # Models without Linear layers (e.g. Discriminator_MNIST) have no bound here, c_g = 0
+    if shapes and shapes[0][1] != input_size[0]:
+        raise ValueError(f"input_size {input_size} does not match first layer in_features {shapes[0][1]}")
+    s = input_bounds
     B_sigma = 0.0
     sum_mk_mkp1 = 0
-    skip_first = True
 
-    for layer in model.modules():
-        if isinstance(layer, nn.Linear):
-            W = torch.ones_like(layer.weight) * c_p
-            sample = W @ sample
-            
-            B_sigma = max(B_sigma, sample.max().detach().item())
-            
-            if skip_first:
-                skip_first = False
-            else:
-                sum_mk_mkp1 += (W.shape[0] + 1) * (W.shape[1] + 1)
+    for k, (out_features, in_features) in enumerate(shapes):
+        s = c_p * in_features * s
+        B_sigma = max(B_sigma, s)
+
+        # Skip the first layer
+        if k > 0:
+            sum_mk_mkp1 += (out_features + 1) * (in_features + 1)
     
     c_g = 2 * c_p * B_sigma * (B_sigma_p ** 2) * sum_mk_mkp1
     print("B_sigma", B_sigma)
@@ -50,21 +50,22 @@ def compute_Tanh_bounds(model, c_p, input_size=(784,), input_bounds=1.0, B_sigma
     return c_g
 
 
+# Set all Linear and Conv2d weights and biases to c_p (in place, no temporary allocations)
+def fill_weights(model, c_p):
+    for layer in model.modules():
+        if isinstance(layer, (nn.Linear, nn.Conv2d)):
+            layer.weight.data.fill_(c_p)
+            if layer.bias is not None:
+                layer.bias.data.fill_(c_p)
+
+
 # Calculate empirical activation bounds
 def compute_empirical_bounds(model, c_p, input_size=(1, 1, 28, 28), input_bounds=1.0, B_sigma_p=1.0):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     sample = torch.ones(input_size).to(device) * input_bounds
 
     # Set all weights to c_p
-    for layer in model.modules():
-        if isinstance(layer, nn.Linear):
-            layer.weight.data = torch.ones_like(layer.weight) * c_p
-            if layer.bias is not None:
-                layer.bias.data = torch.ones_like(layer.bias) * c_p
-        elif isinstance(layer, nn.Conv2d):
-            layer.weight.data = torch.ones_like(layer.weight) * c_p
-            if layer.bias is not None:
-                layer.bias.data = torch.ones_like(layer.bias) * c_p
+    fill_weights(model, c_p)
     
     # Forward pass
     output = model(sample)
@@ -48,7 +48,7 @@ def train(enc, dec, train_loader, lr=5e-4, epochs=1000, run_fp="runs/autoencoder
         for i in tqdm(range(epochs)):
             for j, (data, _) in enumerate(train_loader):
                 # Train with real data
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 output = dec(enc(data))
                 # Reshape output and data
                 output = output.view(-1, 28*28)
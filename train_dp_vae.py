@@ -69,7 +69,7 @@ def train_vae(args, vae, train_loader, run_fp="runs_vae/test", kld_weight=0.0005
             data = next(iter(train_loader))[0].to(device)
         
             # Train with real data
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             output, mu, logvar, std = vae(data)
 
             kld_loss = torch.mean(
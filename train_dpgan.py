@@ -3,12 +3,14 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 from collections import namedtuple
 import os
+import copy
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import generate_run_id, get_input_args, Args
 from models import Discriminator_FC, Discriminator_MNIST, Generator_MNIST, Weight_Clipper, G_weights_init, Generator_FC
 from data import load_MNIST
-from privacy import compute_ReLU_bounds, compute_Tanh_bounds, compute_empirical_bounds
+from privacy import compute_ReLU_bounds, compute_Tanh_bounds, compute_empirical_bounds, fill_weights
 
 import torch
 import torch.nn as nn
@@ -28,11 +30,128 @@ import warnings
 warnings.filterwarnings("ignore")
 
 
+def _penalty_from_gradients(gradients, lambda_gp):
+    # Pointwise tail of the gradient penalty: (||grad||_2 - 1)^2 averaged over the batch,
+    # with the norm taken over all non-batch dims in a single reduction
+    grad_norm = torch.linalg.vector_norm(gradients.flatten(1), ord=2, dim=1)
+    return ((grad_norm - 1) ** 2).mean() * lambda_gp
+
+# Fuse the pointwise penalty chain into a single kernel when torch.compile is available (torch>=2.0).
+# netD itself is left eager since Opacus' per-sample gradient hooks do not survive compilation.
+if hasattr(torch, "compile"):
+    _penalty_from_gradients = torch.compile(_penalty_from_gradients, dynamic=True)
+
+
+def interpolate(real_data, fake_data, alpha=None):
+    """Random per-sample interpolates of real and fake data, as a leaf for the WGAN-GP penalty
+    alpha: optional pre-drawn (batch_size,) interpolation coefficients
+    """
+    if alpha is None:
+        alpha = torch.rand(real_data.size(0), device=real_data.device)
+    # One interpolation coefficient per sample, broadcast over the remaining dims
+    alpha = alpha.view(-1, *[1] * (real_data.dim() - 1))
+
+    # alpha * real + (1 - alpha) * fake as a single fused kernel
+    interpolates = torch.lerp(fake_data, real_data, alpha)
+    return autograd.Variable(interpolates, requires_grad=True)
+
+
+def gradient_penalty(disc_interpolates, interpolates, lambda_gp):
+    """WGAN-GP gradient penalty
+    Penalizes the discriminator gradient norm at the interpolates, given netD(interpolates)
+    """
+    gradients = autograd.grad(
+        outputs=disc_interpolates,
+        inputs=interpolates,
+        grad_outputs=torch.ones_like(disc_interpolates),
+        create_graph=True, 
+        retain_graph=True, 
+        only_inputs=True
+    )[0]
+
+    return _penalty_from_gradients(gradients, lambda_gp)
+
+
+def bf16_available(device):
+    """Whether bfloat16 autocast should be used on device (CUDA with bf16 support)
+    Queries device properties, so call once per run rather than per step
+    """
+    return device.type == "cuda" and torch.cuda.is_bf16_supported()
+
+
+def autocast(device, enabled, cache_enabled=True):
+    """bfloat16 autocast, a no-op unless enabled (see bf16_available)
+    bfloat16 keeps the float32 exponent range, so no gradient scaler is needed
+    cache_enabled must be False when capturing a CUDA graph
+    """
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled, 
+        cache_enabled=cache_enabled)
+
+
+class Graphed_Forward(object):
+    """ Replays a captured CUDA graph of fn(x) for inputs shaped like example_input
+    Inference only (the output has no autograd history), other shapes fall back to calling fn.
+    The returned tensor is a static buffer that is overwritten by the next replay.
+    """
+    def __init__(self, fn, example_input, n_warmup=3):
+        self.fn = fn
+        self.static_input = example_input.clone()
+
+        # Warm up on a side stream before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.no_grad():
+            for _ in range(n_warmup):
+                fn(self.static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph), torch.no_grad():
+            self.static_output = fn(self.static_input)
+
+    def __call__(self, x):
+        if x.shape != self.static_input.shape:
+            return self.fn(x)
+        self.static_input.copy_(x)
+        self.graph.replay()
+        return self.static_output
+
+
+def cpu_state_dict(module):
+    """Detached CPU copy of a state dict, safe to serialize while training continues
+    """
+    return {k: v.detach().to("cpu", copy=True) for k, v in module.state_dict().items()}
+
+
+def write_checkpoint(checkpoint, loss_fp, lines):
+    """Save each object to its path, then append lines to the loss file
+    The loss file is written last since its "Training time" line marks the checkpoint as complete
+    """
+    for fp, obj in checkpoint.items():
+        torch.save(obj, fp)
+    with open(loss_fp, "a") as f:
+        for line in lines:
+            print(line, file=f)
+
+
+def try_script(module):
+    """TorchScript a module, falling back to eager mode if it cannot be scripted
+    """
+    try:
+        return torch.jit.script(module)
+    except Exception as e:
+        # Printed rather than warned, since this module filters warnings
+        print(f"WARNING: TorchScript failed for {module.__class__.__name__} ({type(e).__name__}: {e}), "
+            "falling back to eager mode")
+        return module
+
+
 def train_WGAN(run_fp, args, netD, netG, optimizerD, optimizerG, train_loader, device, 
-        c_g, private=True, verbose=False):
+        c_g, private=True, verbose=False, mixed_precision=False):
     """Training process
     if privacy_engine is not None, then train with DP
     improved: if True, use improved WGAN training process
+    mixed_precision: if True, run the forwards under bfloat16 autocast where supported (changes numerics)
     """
     epoch = 0
     privacy_engine = PrivacyEngine()
@@ -63,6 +182,12 @@ def train_WGAN(run_fp, args, netD, netG, optimizerD, optimizerG, train_loader, d
         netD.load_state_dict(torch.load(f"{run_fp}/netD_{epoch}.pt"))
         netG.load_state_dict(torch.load(f"{run_fp}/netG_{epoch}.pt"))
 
+    # Script the forwards (parameters are shared, so the optimizers stay valid).
+    # Opacus needs module hooks on netD, so it is only scripted when training non-privately.
+    netG = try_script(netG)
+    if not private:
+        netD = try_script(netD)
+
     if private:
         # Setup Privacy Engine
         netD, optimizerD, train_loader = privacy_engine.make_private(
@@ -78,8 +203,33 @@ def train_WGAN(run_fp, args, netD, netG, optimizerD, optimizerG, train_loader, d
     print_mod = 10
     save_mod = 4000
     clipper = Weight_Clipper(args.c_p)
+    clip_weights = Weight_Clipper.weights(netD)
     
-    lines_to_write = []
+    # (label, detached loss) pairs, only copied to the host when written to disk
+    losses_to_write = []
+    # Reuse a single loader iterator, rebuilding it only once exhausted
+    train_iter = iter(train_loader)
+
+    # Mixed precision (discriminator kept in float32 under Opacus, see below)
+    use_bf16 = mixed_precision and bf16_available(device)
+
+    def generate(noise):
+        with autocast(device, use_bf16, cache_enabled=False):
+            return netG(noise).float()
+
+    # The generator forward in the discriminator steps has fixed shapes and needs no gradients,
+    # so capture it once as a CUDA graph (parameters are read in place, so updates are picked up).
+    # Not for private runs: Poisson sampling rarely yields exactly batch_size, so replays would be rare.
+    if device.type == "cuda" and not private:
+        netG.eval()
+        generate_fake = Graphed_Forward(generate, torch.randn(args.batch_size, args.nz, device=device))
+    else:
+        generate_fake = generate
+
+    # Checkpoints are serialized on a single background thread, so writes stay in order
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    save_future = None
+
     tdqm_iter = tqdm(range(epoch, args.n_g))
     while epoch < args.n_g:
         tdqm_iter.update(1)
@@ -89,55 +239,80 @@ def train_WGAN(run_fp, args, netD, netG, optimizerD, optimizerG, train_loader, d
         netD.train()
         netG.eval()
 
+        # Accountant lookups scan the full step history, so only query once per generator step
+        eps = privacy_engine.get_epsilon(args.delta) if (verbose and private) else 0
+
+        # Draw the random inputs for all discriminator steps at once and slice per step.
+        # Not for private runs: Poisson sampling rarely yields exactly batch_size, so they draw per step.
+        if not private:
+            noise_all = torch.randn(args.n_d, args.batch_size, args.nz, device=device)
+            if args.lambda_gp != 0.0:
+                alpha_all = torch.rand(args.n_d, args.batch_size, device=device)
+
         for j in range(args.n_d):
             # Generate real and fake
-            real_data = next(iter(train_loader))[0].to(device)
-            noise = torch.randn(real_data.size(0), args.nz).to(device)
-            fake_data = netG(noise)
-
-            # Run Discriminator_FC
-            real_output = netD(real_data)
-            fake_output = netD(fake_data)
+            try:
+                batch = next(train_iter)
+            except StopIteration:
+                train_iter = iter(train_loader)
+                batch = next(train_iter)
+            real_data = batch[0].to(device, non_blocking=True)
+            # Draw fresh noise for private runs and for a short last batch
+            full_batch = not private and real_data.size(0) == args.batch_size
+            if full_batch:
+                noise = noise_all[j]
+            else:
+                noise = torch.randn(real_data.size(0), args.nz, device=device)
+            # Only netD is updated here, so skip recording the generator's autograd graph
+            with torch.no_grad():
+                fake_data = generate_fake(noise)
+
+            if args.lambda_gp != 0.0:
+                interpolates = interpolate(real_data, fake_data, alpha_all[j] if full_batch else None)
+
+            # Run Discriminator_FC (kept in float32 under Opacus so per-sample clipping norms are exact)
+            with autocast(device, use_bf16 and not private):
+                if private:
+                    # Separate passes so Opacus accumulates real and fake into the same per-sample gradient
+                    real_output = netD(real_data)
+                    fake_output = netD(fake_data)
+                    if args.lambda_gp != 0.0:
+                        disc_interpolates = netD(interpolates)
+                else:
+                    # Single batched pass over real, fake (and interpolates for WGAN-GP)
+                    inputs = [real_data, fake_data]
+                    if args.lambda_gp != 0.0:
+                        inputs.append(interpolates)
+                    outputs = netD(torch.cat(inputs, dim=0)).split([x.size(0) for x in inputs], dim=0)
+                    real_output, fake_output = outputs[:2]
+                    if args.lambda_gp != 0.0:
+                        disc_interpolates = outputs[2]
+
+                # Gradient penalty stays inside the autocast region
+                if args.lambda_gp != 0.0:
+                    grad_penalty = gradient_penalty(disc_interpolates, interpolates, args.lambda_gp)
+            real_output, fake_output = real_output.float(), fake_output.float()
 
             # Calculate loss
             if args.lambda_gp == 0.0:
                 # Standard WGAN loss
                 d_loss = -torch.mean(real_output) + torch.mean(fake_output)
             else:
-                print("Using improved WGAN loss")
                 # Improved WGAN-GP loss
-                alpha = torch.rand(real_data.size(0), 1, 1, 1).to(device)
-                alpha = alpha.expand(real_data.size())
-
-                interpolates = alpha * real_data + ((1 - alpha) * fake_data)
-                interpolates = autograd.Variable(interpolates, requires_grad=True)
-                disc_interpolates = netD(interpolates)
-
-                gradients = autograd.grad(
-                    outputs=disc_interpolates,
-                    inputs=interpolates,
-                    grad_outputs=torch.ones_like(disc_interpolates),
-                    create_graph=True, 
-                    retain_graph=True, 
-                    only_inputs=True
-                )[0]
-
-                grad_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean() * args.lambda_gp
-                d_loss = -torch.mean(real_output) + torch.mean(fake_output) + grad_penalty
-
-            optimizerD.zero_grad()
+                d_loss = -torch.mean(real_output) + torch.mean(fake_output) + grad_penalty.float()
+
+            optimizerD.zero_grad(set_to_none=True)
             d_loss.backward()
             optimizerD.step()
 
             # Clip weights in discriminator (if not using WGAN-GP)
             if args.lambda_gp == 0.0:
-                netD.apply(clipper)
+                clipper.clip_(clip_weights)
 
-            if verbose:
-                print(f"Epoch: {epoch} ({j}/{args.n_d}) D_loss: {d_loss.item()} \
-                    eps: {privacy_engine.get_epsilon(args.delta) if private else 0}")
             if epoch % print_mod == 0:
-                lines_to_write.append(f"{epoch}.{j}, {d_loss.item()}")
+                if verbose:
+                    print(f"Epoch: {epoch} ({j}/{args.n_d}) D_loss: {d_loss.item()} eps: {eps}")
+                losses_to_write.append((f"{epoch}.{j}", d_loss.detach()))
 
         if private:
             netD.disable_hooks()
@@ -146,49 +321,67 @@ def train_WGAN(run_fp, args, netD, netG, optimizerD, optimizerG, train_loader, d
 
         # Update Generator
         noise = torch.randn(args.batch_size, args.nz).to(device)
-        fake_output = netD(netG(noise))
-        g_loss = -torch.mean(fake_output)
+        with autocast(device, use_bf16):
+            fake_data = netG(noise)
+        with autocast(device, use_bf16 and not private):
+            fake_output = netD(fake_data.float())
+        g_loss = -torch.mean(fake_output.float())
 
         # Update Generator
-        optimizerG.zero_grad()
+        optimizerG.zero_grad(set_to_none=True)
         g_loss.backward()
         optimizerG.step()
 
-        if verbose:
-            print(f"Epoch: {epoch} G_loss: {g_loss.item()} \
-                eps: {privacy_engine.get_epsilon(args.delta) if private else 0}")
         if epoch % print_mod == 0:
-            lines_to_write.append(f"{epoch}, {g_loss.item()}")
+            if verbose:
+                print(f"Epoch: {epoch} G_loss: {g_loss.item()} eps: {eps}")
+            losses_to_write.append((f"{epoch}", g_loss.detach()))
 
         epoch += 1
         if epoch % save_mod == 0:
+            # Snapshot everything on the main thread, then serialize on the background thread
+            checkpoint = {f"{run_fp}/netG_{epoch}.pt": cpu_state_dict(netG)}
             # Non-private model
             if not private:
-                torch.save(netG.state_dict(), f"{run_fp}/netG_{epoch}.pt")
-                torch.save(netD.state_dict(), f"{run_fp}/netD_{epoch}.pt")
+                checkpoint[f"{run_fp}/netD_{epoch}.pt"] = cpu_state_dict(netD)
             else:
-                torch.save(netG.state_dict(), f"{run_fp}/netG_{epoch}.pt")
-                torch.save(netD._module.state_dict(), f"{run_fp}/netD_{epoch}.pt")
-                torch.save(privacy_engine.accountant, f"{run_fp}/accountant_{epoch}.pth")
-
-            with open(f"{run_fp}/loss.txt", "a") as f:
-                # Private model
-                # if private:
-                #     eps = privacy_engine.get_epsilon(args.delta)
-                #     print(f"Saving model at iteration {epoch}, epsilon {eps}")
-                #     print(f"{epoch}: epsilon {eps}", file=f)
-                
-                for line in lines_to_write:
-                    print(line, file=f)
-                lines_to_write = []
-                print(f"{epoch} Training time: {time() - start_time}", file=f)
+                checkpoint[f"{run_fp}/netD_{epoch}.pt"] = cpu_state_dict(netD._module)
+                checkpoint[f"{run_fp}/accountant_{epoch}.pth"] = copy.deepcopy(privacy_engine.accountant)
+
+            # Private model
+            # if private:
+            #     eps = privacy_engine.get_epsilon(args.delta)
+            #     print(f"Saving model at iteration {epoch}, epsilon {eps}")
+            #     print(f"{epoch}: epsilon {eps}", file=f)
+
+            # Single device to host copy for all buffered losses
+            lines = []
+            if losses_to_write:
+                loss_vals = torch.stack([loss for _, loss in losses_to_write]).cpu().tolist()
+                lines = [f"{label}, {loss_val}" for (label, _), loss_val in zip(losses_to_write, loss_vals)]
+            losses_to_write = []
+            lines.append(f"{epoch} Training time: {time() - start_time}")
+
+            # Surface errors from the previous save and keep at most one save in flight
+            if save_future is not None:
+                save_future.result()
+            save_future = save_executor.submit(write_checkpoint, checkpoint, f"{run_fp}/loss.txt", lines)
+
+    # Wait for the last checkpoint to be written
+    if save_future is not None:
+        save_future.result()
+    save_executor.shutdown(wait=True)
     
     # Save train time
     with open(f"{run_fp}/loss.txt", "a") as f:
         print(f"Training time: {time() - start_time}")
 
 
-def main(args, private=True, use_public_data=False, c_g_mult=1.0):
+def main(args, private=True, use_public_data=False, c_g_mult=1.0, loaders=None, mixed_precision=False):
+    """Train a single (DP-)WGAN run
+    loaders: optional load_MNIST output shared across a sweep, reloaded if the batch size differs
+    mixed_precision: passed to train_WGAN, off by default so results match float32 runs
+    """
     # Random Seeding
     torch.manual_seed(0)
     np.random.seed(0)
@@ -228,19 +421,25 @@ def main(args, private=True, use_public_data=False, c_g_mult=1.0):
     # netG.apply(G_weights_init)
     netG = Generator_FC(hidden_sizes=[256], nz=args.nz, output_size=(1, 28, 28)).to(device)
 
-    # Privacy Validation
-    ModuleValidator.validate(netD, strict=True)
+    # Gradient clip bound (unused when training non-privately)
+    c_g = float("inf")
+    if private:
+        # Privacy Validation
+        ModuleValidator.validate(netD, strict=True)
 
-    if args.activation == "LeakyReLU":
-        c_g = compute_ReLU_bounds(netD, args.c_p)
-    elif args.activation == "Tanh":
-        c_g = compute_Tanh_bounds(netD, args.c_p)
+        if args.activation == "LeakyReLU":
+            c_g = compute_ReLU_bounds(netD, args.c_p)
+        elif args.activation == "Tanh":
+            c_g = compute_Tanh_bounds(netD, args.c_p)
 
-    # Use empirical c_g
-    emp_c_g = compute_empirical_bounds(netD, args.c_p)
-    c_g = c_g_mult * emp_c_g
+        # Use empirical c_g
+        emp_c_g = compute_empirical_bounds(netD, args.c_p)
+        c_g = c_g_mult * emp_c_g
 
-    print("Gradient clip:", c_g)
+        print("Gradient clip:", c_g)
+    else:
+        # Same c_p-filled netD that compute_empirical_bounds leaves behind for private runs
+        fill_weights(netD, args.c_p)
     
     # Setup optimizers
     weight_decay = 1e-6
@@ -248,7 +447,9 @@ def main(args, private=True, use_public_data=False, c_g_mult=1.0):
     optimizerG = optim.Adam(netG.parameters(), lr=args.lr, betas=(args.beta1, 0.9), weight_decay=weight_decay)
 
     # Setup MNIST dataset using load_MNIST
-    labeling_loader, public_loader, private_loader, test_loader = load_MNIST(args.batch_size)
+    if loaders is None or loaders[0].batch_size != args.batch_size:
+        loaders = load_MNIST(args.batch_size)
+    labeling_loader, public_loader, private_loader, test_loader = loaders
     
     if use_public_data:
         train_loader = public_loader
@@ -258,12 +459,15 @@ def main(args, private=True, use_public_data=False, c_g_mult=1.0):
     verbose = False
     # verbose = True
     train_WGAN(run_fp, args, netD, netG, optimizerD, optimizerG, train_loader, device, 
-        c_g, private, verbose=verbose)
+        c_g, private, verbose=verbose, mixed_precision=mixed_precision)
 
 
 def train_non_private():
+    # Load MNIST once and share the loaders (and their workers) across runs
+    loaders = load_MNIST(64, num_workers=4)
+
     args = Args(hidden=[256], nz=100, ngf=32, nc=1, epsilon='inf', delta=1e-06, noise_multiplier=0.0, c_p=0.01, lr=5e-05, beta1=0.0, batch_size=64, n_d=3, n_g=int(5e5), activation='LeakyReLU', lambda_gp=0.0)
-    main(args, private=False, use_public_data=True)
+    main(args, private=False, use_public_data=True, loaders=loaders)
 
     exit(0)
 
@@ -313,7 +517,7 @@ def train_non_private():
                                 # Training Parameters
                                 lr=lr, beta1=0.0, batch_size=64, n_d=n_d, n_g=int(2e5), lambda_gp=lambda_gp
                             )
-                            main(args, private=False, use_public_data=True)
+                            main(args, private=False, use_public_data=True, loaders=loaders)
 
 def grid_search():
     # Private model Hyperparameter Search
@@ -322,6 +526,10 @@ def grid_search():
     activations = ["LeakyReLU",] # "Tanh",]
     lambda_gps = [0.0, 10.0]
 
+    # Load MNIST once and share the loaders across runs. No workers: make_private builds a new
+    # DPDataLoader for every run, so each run would respawn them
+    loaders = load_MNIST(64)
+
     for hidden in hiddens:
         for noise_multiplier in noise_multipliers:
             for activation in activations:
@@ -334,7 +542,7 @@ def grid_search():
                         # Training Parameters
                         lr=1e-4, beta1=0.5, batch_size=64, n_d=5, n_g=int(2e5), lambda_gp=lambda_gp
                     )
-                    main(args, c_g_mult=2.0)
+                    main(args, c_g_mult=2.0, loaders=loaders)
 
 if __name__ == "__main__":
     # Collect all parameters